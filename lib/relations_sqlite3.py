@@ -4,9 +4,9 @@ Module for intersting with sqlite3
 
 # pylint: disable=arguments-differ,unsupported-membership-test
 
-import glob
-import copy
 import json
+import os
+import re
 
 import sqlite3
 
@@ -40,15 +40,37 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
 
     KIND = "sqlite"
 
+    RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0) # Whether INSERT ... RETURNING is supported
+
+    PRAGMAS = { # Tuned settings used when pragmas=True
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "temp_store": "MEMORY",
+        "mmap_size": 268435456
+    }
+
+    DDL_FILE = re.compile(r"^(\w+)-([^.]+).*\.sql$") # kind-stamp.sql files in a source path
+
     database = None   # Database to use
     connection = None # Connection
     created = False   # If we created the connection
 
-    def __init__(self, name, database, connection=None, schemas=None, **kwargs):
+    def __init__(self, name, database, connection=None, schemas=None, pragmas=None, **kwargs):
 
         self.database = database
         self.schemas = schemas if schemas is not None else {}
         self.schema = self.schemas.get('main')
+        self.pragmas = pragmas if pragmas else {}
+
+        if self.pragmas is True:
+
+            self.pragmas = dict(self.PRAGMAS)
+
+            # In memory databases have no journal file to put in WAL mode
+
+            if self.database == ":memory:":
+                self.pragmas.pop("journal_mode")
 
         if connection is not None:
             self.connection = connection
@@ -57,13 +79,22 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
 
             self.connection = sqlite3.connect(
                 self.database,
-                **{name: arg for name, arg in kwargs.items() if name not in ["name", "database", "schemas", "connection"]}
+                **{name: arg for name, arg in kwargs.items() if name not in ["name", "database", "schemas", "pragmas", "connection"]}
             )
 
-            cursor = self.connection.cursor()
+        cursor = self.connection.cursor()
+
+        # Pragmas apply to whichever connection we have, ahead of any attaching
+
+        for pragma in sorted(self.pragmas.keys()):
+            cursor.execute(f"PRAGMA {pragma}={self.pragmas[pragma]}")
+
+        if self.created:
             for schema in sorted(self.schemas.keys()):
                 if schema != 'main':
-                    cursor.execute(f"ATTACH DATABASE '{self.schemas[schema]}' AS `{schema}`")
+                    cursor.execute(f"ATTACH DATABASE ? AS `{schema}`", (self.schemas[schema],))
+
+        cursor.close()
 
         self.connection.row_factory = sqlite3.Row
 
@@ -81,8 +112,11 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
             commands.generate()
             commands = commands.sql
 
+        # A script runs in one pass in sqlite3, committing as it goes
+
         if not isinstance(commands, list):
-            commands = commands.split(";\n")
+            self.connection.executescript(commands)
+            return
 
         cursor = self.connection.cursor()
 
@@ -113,6 +147,8 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         if model._id is not None and model._fields._names[model._id].auto is None and model._fields._names[model._id].kind == int:
             model._fields._names[model._id].auto = True
 
+        model._jsonify = [field.store for field in model._fields._order if field.kind not in [bool, int, float, str]]
+
     def define(self, migration=None, definition=None):
         """
         Creates the DDL for a model
@@ -134,7 +170,7 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         if not model._bulk and model._id is not None and model._fields._names[model._id].auto:
             if model._mode == "many":
                 raise relations.ModelError(model, "only one create query at a time")
-            return copy.deepcopy(query).VALUES(**model._record.create({})).bind(model)
+            return query.VALUES(**model._record.create({})).bind(model)
 
         for creating in model._each("create"):
             query.VALUES(**creating._record.create({}))
@@ -152,28 +188,62 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
 
         model[model._id] = cursor.lastrowid
 
+    def create_ids(self, cursor, models):
+        """
+        Inserts multiple records in a single statement and sets their ids
+        """
+
+        model = models[0]
+        store = model._fields._names[model._id].store
+
+        fields = [field.store for field in model._fields._order if not field.auto and not field.inject]
+        query = self.INSERT(self.TABLE_NAME(model.STORE, schema=model.SCHEMA), *fields)
+
+        for creating in models:
+            query.VALUES(**creating._record.create({}))
+
+        query.generate()
+        cursor.execute(f"{query.sql} RETURNING `{store}`", tuple(query.args))
+
+        # RETURNING order is arbitrary, but ids are assigned ascending within a statement
+
+        cursor.row_factory = None
+
+        for creating, created in zip(models, sorted(row[0] for row in cursor.fetchall())):
+            creating[creating._id] = created
+
     def create(self, model, query=None):
         """
         Executes the create
         """
 
-        cursor = self.connection.cursor()
+        creatings = model._each("create")
 
-        if not model._bulk and model._id is not None and model._fields._names[model._id].auto:
-            for creating in model._each("create"):
-                create_query = query or self.create_query(creating)
-                self.create_id(cursor, creating, create_query)
-        else:
-            create_query = query or self.create_query(model)
-            create_query.generate()
-            cursor.execute(create_query.sql, tuple(create_query.args))
+        with self.connection:
 
-        cursor.close()
+            cursor = self.connection.cursor()
+
+            if not model._bulk and model._id is not None and model._fields._names[model._id].auto:
+                if query is None and self.RETURNING:
+                    for start in range(0, len(creatings), model._chunk):
+                        self.create_ids(cursor, creatings[start:start + model._chunk])
+                else:
+                    for creating in creatings:
+                        create_query = query or self.create_query(creating)
+                        self.create_id(cursor, creating, create_query)
+            else:
+                create_query = query or self.create_query(model)
+                create_query.generate()
+                cursor.execute(create_query.sql, tuple(create_query.args))
+
+            cursor.close()
 
         if not model._bulk:
 
-            for creating in model._each("create"):
-                for parent_child in creating.CHILDREN:
+            children = model.CHILDREN
+
+            for creating in creatings:
+                for parent_child in children:
                     if creating._children.get(parent_child):
                         creating._children[parent_child].create()
                 creating._action = "update"
@@ -202,23 +272,31 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         Adds like information to the query
         """
 
-        if model._like is None:
+        like = model._like
+
+        if like is None:
             return
 
+        # Model attribute access goes through __getattribute__ so grab what the loop needs once
+
+        names = model._fields._names
+        parents = model.PARENTS.values()
+
         titles = self.OR()
+        likes = []
 
         for name in model._titles:
 
             path = name.split("__", 1)
             name = path.pop(0)
 
-            field = model._fields._names[name]
+            field = names[name]
 
             parent = False
 
-            for relation in model.PARENTS.values():
+            for relation in parents:
                 if field.name == relation.child_field:
-                    parent = relation.Parent.many(like=model._like).limit(model._chunk)
+                    parent = relation.Parent.many(like=like).limit(model._chunk)
                     if parent[relation.parent_field]:
                         titles(self.IN(field.store, parent[relation.parent_field]))
                         model.overflow = model.overflow or parent.overflow
@@ -231,9 +309,14 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
 
                 if paths:
                     for path in paths:
-                        titles(self.LIKE(f"{field.store}__{path}", model._like, extracted=path in (field.extract or {})))
+                        likes.append(self.LIKE(f"{field.store}__{path}", like, extracted=path in (field.extract or {})))
                 else:
-                    titles(self.LIKE(field.store, model._like))
+                    likes.append(self.LIKE(field.store, like))
+
+        # Parent id matches go ahead of the LIKEs so a hit skips the pattern matching
+
+        for title in likes:
+            titles(title)
 
         if titles:
             query.WHERE(titles)
@@ -254,11 +337,10 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         Adds sort informaiton to the query
         """
 
-        if model._limit is not None:
-            query.LIMIT(model._limit)
+        # SQLite only takes an OFFSET after a LIMIT, with -1 meaning no limit
 
-        if model._offset:
-            query.LIMIT(model._offset)
+        if model._limit is not None or model._offset:
+            query.LIMIT(total=model._limit if model._limit is not None else -1, offset=model._offset or None)
 
     def count_query(self, model):
         """
@@ -299,16 +381,19 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         Executes the count
         """
 
-        cursor = self.connection.cursor()
-
         if query is None:
             query = self.count_query(model)
 
         query.generate()
 
-        cursor.execute(query.sql, query.args)
+        cursor = self.connection.execute(query.sql, query.args)
 
-        total = cursor.fetchone()["total"] if cursor.rowcount else 0
+        # rowcount is -1 for SELECTs, so go off whether a row came back
+
+        cursor.row_factory = None
+        row = cursor.fetchone()
+
+        total = row[0] if row is not None else 0
 
         cursor.close()
 
@@ -317,32 +402,52 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
     @staticmethod
     def values_retrieve(model, values):
         """
-        Encodes the fields in json if needed
+        Decodes the fields from json if needed
         """
-        for field in model._fields._order:
-            if isinstance(values.get(field.store), str) and field.kind not in [bool, int, float, str]:
-                values[field.store] = json.loads(values[field.store])
+
+        for store in model._jsonify:
+            if isinstance(values.get(store), str):
+                values[store] = json.loads(values[store])
 
         return values
 
-    def retrieve(self, model, verify=True, query=None):
+    def retrieve_cursor(self, model, query=None):
         """
-        Executes the retrieve
+        Executes the retrieve query, returning the cursor and column names
         """
 
-        cursor = self.connection.cursor()
-
         if query is None:
             query = self.retrieve_query(model)
 
         query.generate()
 
-        cursor.execute(query.sql, tuple(query.args))
+        cursor = self.connection.execute(query.sql, tuple(query.args))
+
+        # Rows come back as plain tuples, zipped with column names read just once
+
+        cursor.row_factory = None
+
+        return cursor, [description[0] for description in cursor.description]
+
+    def retrieve(self, model, verify=True, query=None):
+        """
+        Executes the retrieve
+        """
 
-        rows = cursor.fetchall()
+        cursor, names = self.retrieve_cursor(model, query)
 
-        if model._mode == "one" and len(rows) > 1:
-            raise relations.ModelError(model, "more than one retrieved")
+        # Many rows stream straight off the cursor, one only needs to know if there's a second
+
+        if model._mode == "one":
+
+            rows = cursor.fetchmany(2)
+
+            if len(rows) > 1:
+                raise relations.ModelError(model, "more than one retrieved")
+
+        else:
+
+            rows = cursor
 
         if model._mode == "one" and model._role != "child":
 
@@ -352,14 +457,13 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
                     raise relations.ModelError(model, "none retrieved")
                 return None
 
-            model._record = model._build("update", _read=self.values_retrieve(model, dict(rows[0])))
+            model._record = model._build("update", _read=self.values_retrieve(model, dict(zip(names, rows[0]))))
 
         else:
 
-            model._models = []
+            cls = model.__class__
 
-            for row in rows:
-                model._models.append(model.__class__(_read=self.values_retrieve(model, dict(row))))
+            model._models = [cls(_read=self.values_retrieve(model, dict(zip(names, row)))) for row in rows]
 
             if model._limit is not None:
                 model.overflow = model.overflow or len(model._models) >= model._limit
@@ -372,6 +476,21 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
 
         return model
 
+    def retrieve_iter(self, model, query=None):
+        """
+        Yields the retrieved models a row at a time
+        """
+
+        cursor, names = self.retrieve_cursor(model, query)
+
+        cls = model.__class__
+
+        try:
+            for row in cursor:
+                yield cls(_read=self.values_retrieve(model, dict(zip(names, row))))
+        finally:
+            cursor.close()
+
     def titles(self, model, query=None):
         """
         Creates the titles structure
@@ -428,44 +547,57 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         Executes the update
         """
 
-        cursor = self.connection.cursor()
-
         updated = 0
+        updatings = []
 
-        # If the overall model is retrieving and the record has values set
+        with self.connection:
 
-        if model._action == "retrieve" and model._record._action == "update":
+            # If the overall model is retrieving and the record has values set
 
-            update_query = query or self.update_query(model)
+            if model._action == "retrieve" and model._record._action == "update":
 
-            update_query.generate()
-            cursor.execute(update_query.sql, update_query.args)
-            updated = cursor.rowcount
+                update_query = query or self.update_query(model)
 
-        elif model._id:
+                update_query.generate()
+                updated = self.connection.execute(update_query.sql, update_query.args).rowcount
 
-            for updating in model._each("update"):
+            elif model._id:
 
-                update_query = query or self.update_query(updating)
+                # Records changing the same fields share SQL, so each shape executes once
 
-                if update_query.SET:
+                batches = {}
+                updatings = model._each("update")
 
-                    update_query.generate()
-                    cursor.execute(update_query.sql, update_query.args)
+                for updating in updatings:
 
-                for parent_child in updating.CHILDREN:
-                    if updating._children.get(parent_child):
-                        updating._children[parent_child].create().update()
+                    update_query = query or self.update_query(updating)
 
-                updated += cursor.rowcount
+                    if update_query.SET:
 
-        else:
+                        update_query.generate()
+                        batches.setdefault(update_query.sql, []).append(update_query.args)
 
-            raise relations.ModelError(model, "nothing to update from")
+                for sql, args in batches.items():
+                    updated += self.connection.executemany(sql, args).rowcount
+
+            else:
+
+                raise relations.ModelError(model, "nothing to update from")
+
+        # Children commit on their own, so they only go once the parent rows have
+
+        if updatings:
+
+            children = model.CHILDREN
+
+            for updating in updatings:
+                for parent_child in children:
+                    if updating._children.get(parent_child):
+                        updating._children[parent_child].create().update()
 
         return updated
 
-    def delete_query(self, model):
+    def delete_query(self, model, ids=None):
         """
         Create the update query
         """
@@ -478,10 +610,10 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
 
         elif model._id:
 
-            ids = []
+            if ids is None:
+                ids = [deleting[model._id] for deleting in model._each()]
+
             store = model._fields._names[model._id].store
-            for deleting in model._each():
-                ids.append(deleting[model._id])
             query.WHERE(**{f"{store}__in": ids})
 
         else:
@@ -495,14 +627,23 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         Executes the delete
         """
 
-        cursor = self.connection.cursor()
+        # Deleting by id goes in chunks so the IN list stays under SQLite's variable limit
+
+        if query is None and model._action != "retrieve" and model._id:
+            ids = [deleting[model._id] for deleting in model._each()]
+            delete_queries = [self.delete_query(model, ids[start:start + model._chunk]) for start in range(0, len(ids), model._chunk)]
+        else:
+            delete_queries = [query or self.delete_query(model)]
 
-        delete_query = query or self.delete_query(model)
+        deleted = 0
 
-        delete_query.generate()
-        cursor.execute(delete_query.sql, tuple(delete_query.args))
+        with self.connection:
 
-        return cursor.rowcount
+            for delete_query in delete_queries:
+                delete_query.generate()
+                deleted += self.connection.execute(delete_query.sql, tuple(delete_query.args)).rowcount
+
+        return deleted
 
     def definition(self, file_path, source_path):
         """"
@@ -512,7 +653,7 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         definitions = []
 
         with open(file_path, "r") as definition_file:
-            definition = json.load(definition_file)
+            definition = json.loads(definition_file.read())
             for name in sorted(definition.keys()):
                 if definition[name]["source"] == self.name:
                     definitions.append(self.define(definition[name]))
@@ -530,7 +671,7 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         migrations = []
 
         with open(file_path, "r") as migration_file:
-            migration = json.load(migration_file)
+            migration = json.loads(migration_file.read())
 
             for add in sorted(migration.get('add', {}).keys()):
                 if migration['add'][add]["source"] == self.name:
@@ -557,7 +698,7 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
         """
 
         with open(load_path, 'r') as load_file:
-            self.execute(load_file.read().split(";\n"))
+            self.execute(load_file.read())
 
     def list(self, source_path):
         """
@@ -566,13 +707,18 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
 
         migrations = {}
 
-        for file_path in glob.glob(f"{source_path}/*-*.sql"):
+        if not os.path.isdir(source_path):
+            return migrations
+
+        with os.scandir(source_path) as entries:
+
+            for entry in entries:
 
-            file_name = file_path.rsplit("/", 1)[-1]
-            kind, stamp = file_name.split('.')[0].split('-', 1)
+                match = self.DDL_FILE.match(entry.name)
 
-            migrations.setdefault(stamp, {})
-            migrations[stamp][kind] = file_name
+                if match:
+                    kind, stamp = match.groups()
+                    migrations.setdefault(stamp, {})[kind] = entry.name
 
         return migrations
 
@@ -598,29 +744,26 @@ class Source(relations.Source): # pylint: disable=too-many-public-methods
 
         stamps = Migration.many().stamp
 
-        migration_paths = sorted(glob.glob(f"{source_path}/migration-*.sql"))
+        migrations = self.list(source_path)
+        migration_stamps = sorted(stamp for stamp, files in migrations.items() if "migration" in files)
 
         if not stamps:
 
             migration = Migration().bulk().add("definition")
 
-            for migration_path in migration_paths:
-                stamp = migration_path.rsplit("/migration-", 1)[-1].split('.')[0]
+            for stamp in migration_stamps:
                 migration.add(stamp)
 
             migration.create()
-            self.connection.commit()
             self.load(f"{source_path}/definition.sql")
             migrated = True
 
         else:
 
-            for migration_path in migration_paths:
-                stamp = migration_path.rsplit("/migration-", 1)[-1].split('.')[0]
+            for stamp in migration_stamps:
                 if stamp not in stamps:
                     Migration(stamp).create()
-                    self.connection.commit()
-                    self.load(migration_path)
+                    self.load(f"{source_path}/{migrations[stamp]['migration']}")
                     migrated = True
 
         return migrated
@@ -2,9 +2,9 @@ import unittest
 import unittest.mock
 
 import os
+import types
 import shutil
 import pathlib
-import copy
 import json
 
 import sqlite3
@@ -96,26 +96,23 @@ class TestSource(unittest.TestCase):
 
     def setUp(self):
 
-        self.source = relations_sqlite3.Source("SQLite3Source", "/main.db", schemas={
+        self.source = relations_sqlite3.Source("SQLite3Source", ":memory:", schemas={
             "main": "test_source",
-            "test_source": "/test_source.db"
+            "test_source": ":memory:"
         })
 
         self.source.connection.row_factory = dict_factory
 
+        self.cursor = self.source.connection.cursor()
+
         shutil.rmtree("ddl", ignore_errors=True)
         os.makedirs("ddl", exist_ok=True)
 
     def tearDown(self):
 
+        self.cursor.close()
         self.source.connection.close()
 
-        if os.path.exists("/test_source.db"):
-            os.remove("/test_source.db")
-
-        if os.path.exists("/main.db"):
-            os.remove("/main.db")
-
     @unittest.mock.patch("relations.SOURCES", {})
     @unittest.mock.patch("sqlite3.connect", unittest.mock.MagicMock())
     def test___init__(self):
@@ -129,6 +126,19 @@ class TestSource(unittest.TestCase):
         self.assertEqual(source.connection, connection)
         self.assertEqual(source.connection.row_factory, sqlite3.Row)
         self.assertEqual(relations.SOURCES["unit"], source)
+        connection.cursor.return_value.execute.assert_not_called()
+
+        connection = unittest.mock.MagicMock()
+
+        source = relations_sqlite3.Source("given", "given.db", connection=connection, pragmas=True)
+        self.assertEqual(source.pragmas, relations_sqlite3.Source.PRAGMAS)
+        connection.cursor.return_value.execute.assert_has_calls([
+            unittest.mock.call("PRAGMA cache_size=-65536"),
+            unittest.mock.call("PRAGMA journal_mode=WAL"),
+            unittest.mock.call("PRAGMA mmap_size=268435456"),
+            unittest.mock.call("PRAGMA synchronous=NORMAL"),
+            unittest.mock.call("PRAGMA temp_store=MEMORY")
+        ])
 
         source = relations_sqlite3.Source("test", "init.db", schemas={"main": "init", "other": "other.db"}, extra="stuff")
         self.assertTrue(source.created)
@@ -141,6 +151,34 @@ class TestSource(unittest.TestCase):
         self.assertEqual(relations.SOURCES["test"], source)
         sqlite3.connect.assert_called_once_with("init.db", extra="stuff")
 
+        source = relations_sqlite3.Source("tune", "tune.db", pragmas={"synchronous": "NORMAL", "journal_mode": "WAL"})
+        self.assertEqual(source.pragmas, {"synchronous": "NORMAL", "journal_mode": "WAL"})
+        sqlite3.connect.assert_called_with("tune.db")
+        sqlite3.connect.return_value.cursor.return_value.execute.assert_has_calls([
+            unittest.mock.call("PRAGMA journal_mode=WAL"),
+            unittest.mock.call("PRAGMA synchronous=NORMAL")
+        ])
+
+        source = relations_sqlite3.Source("attach", "attach.db", schemas={"main": "people", "people": "it's.db"})
+        sqlite3.connect.return_value.cursor.return_value.execute.assert_called_with("ATTACH DATABASE ? AS `people`", ("it's.db",))
+
+        source = relations_sqlite3.Source("tuned", "tuned.db", pragmas=True)
+        self.assertEqual(source.pragmas, relations_sqlite3.Source.PRAGMAS)
+        sqlite3.connect.return_value.cursor.return_value.execute.assert_has_calls([
+            unittest.mock.call("PRAGMA cache_size=-65536"),
+            unittest.mock.call("PRAGMA journal_mode=WAL"),
+            unittest.mock.call("PRAGMA mmap_size=268435456"),
+            unittest.mock.call("PRAGMA synchronous=NORMAL"),
+            unittest.mock.call("PRAGMA temp_store=MEMORY")
+        ])
+
+        source = relations_sqlite3.Source("plain", "plain.db", pragmas=False)
+        self.assertEqual(source.pragmas, {})
+
+        source = relations_sqlite3.Source("memory", ":memory:", pragmas=True)
+        self.assertNotIn("journal_mode", source.pragmas)
+        self.assertEqual(source.pragmas["synchronous"], "NORMAL")
+
     @unittest.mock.patch("relations.SOURCES", {})
     @unittest.mock.patch("sqlite3.connect", unittest.mock.MagicMock())
     def test___del__(self):
@@ -163,23 +201,28 @@ class TestSource(unittest.TestCase):
   `name` TEXT NOT NULL
 )"""))
 
-        cursor = self.source.connection.cursor()
-
-        cursor.execute("SELECT * FROM pragma_table_info('simple')")
+        self.cursor.execute("SELECT * FROM pragma_table_info('simple')")
 
-        id = cursor.fetchone()
+        id = self.cursor.fetchone()
         self.assertEqual(id["name"], "id")
         self.assertEqual(id["type"], "INTEGER")
 
-        name = cursor.fetchone()
+        name = self.cursor.fetchone()
         self.assertEqual(name["name"], "name")
         self.assertEqual(name["type"], "TEXT")
 
+        self.source.execute("CREATE TABLE `script` (`id` INTEGER);\nINSERT INTO `script` VALUES (1);INSERT INTO `script` VALUES (2)")
+        self.source.execute(["INSERT INTO `script` VALUES (3)", " "])
+
+        self.cursor.execute("SELECT COUNT(*) AS `total` FROM `script`")
+        self.assertEqual(self.cursor.fetchone()["total"], 3)
+
     def test_init(self):
 
         class Check(relations.Model):
             id = int
             name = str
+            things = dict
 
         model = Check()
 
@@ -187,6 +230,7 @@ class TestSource(unittest.TestCase):
 
         self.assertEqual(model.STORE, "check")
         self.assertTrue(model._fields._names["id"].auto)
+        self.assertEqual(model._jsonify, ["things"])
 
     def test_define(self):
 
@@ -228,14 +272,34 @@ CREATE UNIQUE INDEX `test_source`.`simple_name` ON `simple` (`name`);
 
         query = self.source.create_query(simple)
 
-        cursor = self.source.connection.cursor()
+        self.source.create_id(self.cursor, simple, query)
 
-        self.source.create_id(cursor, simple, query)
+        self.cursor.execute("SELECT * FROM test_source.simple")
+        self.assertEqual(self.cursor.fetchone()["id"], simple.id)
 
-        cursor.execute("SELECT * FROM test_source.simple")
-        self.assertEqual(cursor.fetchone()["id"], simple.id)
+    def test_create_ids(self):
 
-        cursor.close()
+        self.source.execute(Simple.define())
+        self.source.execute(Plain.define())
+
+        Simple("sure").create()
+
+        simples = [Simple("fine"), Simple("ya"), Simple("yep")]
+
+        self.source.create_ids(self.source.connection.cursor(), simples)
+
+        self.assertEqual([simple.id for simple in simples], [2, 3, 4])
+
+        self.cursor.execute("SELECT * FROM test_source.simple ORDER BY id")
+        self.assertEqual(self.cursor.fetchall(), [
+            {"id": 1, "name": "sure"},
+            {"id": 2, "name": "fine"},
+            {"id": 3, "name": "ya"},
+            {"id": 4, "name": "yep"}
+        ])
+
+        self.source.connection.row_factory = None
+        self.assertEqual(Simple([["tuple"], ["rows"]]).create().id, [5, 6])
 
     def test_create(self):
 
@@ -255,23 +319,38 @@ CREATE UNIQUE INDEX `test_source`.`simple_name` ON `simple` (`name`);
         self.assertEqual(simple.plain._action, "update")
         self.assertEqual(simple.plain[0]._record._action, "update")
 
-        cursor = self.source.connection.cursor()
+        self.cursor.execute("SELECT * FROM test_source.simple")
+        self.assertEqual(self.cursor.fetchone(), {"id": 1, "name": "sure"})
 
-        cursor.execute("SELECT * FROM test_source.simple")
-        self.assertEqual(cursor.fetchone(), {"id": 1, "name": "sure"})
+        self.assertFalse(self.source.connection.in_transaction)
 
         simples = Simple.bulk().add("ya").create()
         self.assertEqual(simples._models, [])
 
-        cursor.execute("SELECT * FROM test_source.simple WHERE name='ya'")
-        self.assertEqual(cursor.fetchone(), {"id": 2, "name": "ya"})
+        self.cursor.execute("SELECT * FROM test_source.simple WHERE name='ya'")
+        self.assertEqual(self.cursor.fetchone(), {"id": 2, "name": "ya"})
+
+        self.cursor.execute("SELECT * FROM test_source.plain")
+        self.assertEqual(self.cursor.fetchone(), {"simple_id": 1, "name": "fine"})
+
+        simples = Simple([["many"], ["more"], ["most"]], _chunk=2).create()
+        self.assertEqual(simples.id, [3, 4, 5])
+        self.assertEqual(simples._action, "update")
+        self.assertEqual(simples[0]._record._action, "update")
 
-        cursor.execute("SELECT * FROM test_source.plain")
-        self.assertEqual(cursor.fetchone(), {"simple_id": 1, "name": "fine"})
+        with unittest.mock.patch.object(relations_sqlite3.Source, "RETURNING", False):
+            simples = Simple([["less"], ["least"]]).create()
+            self.assertEqual(simples.id, [6, 7])
+
+        statements = []
+        self.source.connection.set_trace_callback(statements.append)
+        Simple.bulk().add("a").add("b").add("c").create()
+        self.source.connection.set_trace_callback(None)
+        self.assertEqual(len([statement for statement in statements if statement.startswith("INSERT")]), 1)
 
         model = Meta("yep", True, 3.50, {"tom", "mary"}, [1, None], {"for": [{"1": "yep"}]}, "sure").create()
-        cursor.execute("SELECT * FROM test_source.meta")
-        self.assertEqual(self.source.values_retrieve(model, dict(cursor.fetchone())), {
+        self.cursor.execute("SELECT * FROM test_source.meta")
+        self.assertEqual(self.source.values_retrieve(model, dict(self.cursor.fetchone())), {
             "id": 1,
             "name": "yep",
             "flag": 1,
@@ -282,7 +361,39 @@ CREATE UNIQUE INDEX `test_source`.`simple_name` ON `simple` (`name`);
             "things__for__0____1": "yep"
         })
 
-        cursor.close()
+    def test_create_statements(self):
+
+        statements = []
+
+        class RecordingCursor(sqlite3.Cursor):
+
+            def execute(self, sql, parameters=()):
+                statements.append(sql)
+                return super().execute(sql, parameters)
+
+        class RecordingConnection(sqlite3.Connection):
+
+            def cursor(self, factory=RecordingCursor):
+                return super().cursor(factory)
+
+        connection = sqlite3.connect(":memory:", factory=RecordingConnection)
+        connection.execute("ATTACH DATABASE ':memory:' AS `test_source`")
+
+        source = relations_sqlite3.Source("SQLite3Source", ":memory:", connection=connection, schemas={"main": "test_source"})
+
+        source.execute(Simple.define())
+        source.execute(Plain.define())
+
+        Simple("once").create()
+        Simple("twice").create()
+
+        # Single creates should send the same text so sqlite3 reuses the prepared statement
+
+        inserts = [statement for statement in statements if statement.startswith("INSERT")]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(inserts[0], inserts[1])
+
+        connection.close()
 
     def test_retrieve_field(self):
 
@@ -366,6 +477,14 @@ CREATE UNIQUE INDEX `test_source`.`simple_name` ON `simple` (`name`);
         self.assertEqual(query.args, [unit.id, '%p%'])
         self.assertTrue(test.overflow)
 
+        test = Test.many(like="p")
+        test._titles = ["name", "unit_id"]
+        query = self.source.SELECT()
+        self.source.like(test, query)
+        query.generate()
+        self.assertEqual(query.sql, """SELECT WHERE (`unit_id` IN (?) OR `name` LIKE ?)""")
+        self.assertEqual(query.args, [unit.id, '%p%'])
+
         Unit.many().delete()
         test = Test.many(like="p")
         query = self.source.SELECT()
@@ -433,6 +552,13 @@ CREATE UNIQUE INDEX `test_source`.`simple_name` ON `simple` (`name`);
         self.assertEqual(query.sql, """SELECT LIMIT ? OFFSET ?""")
         self.assertEqual(query.args, [2, 1])
 
+        query = self.source.SELECT()
+        unit._limit = None
+        self.source.limit(unit, query)
+        query.generate()
+        self.assertEqual(query.sql, """SELECT LIMIT ? OFFSET ?""")
+        self.assertEqual(query.args, [-1, 1])
+
     def test_count_query(self):
 
         self.source.execute(Unit.define())
@@ -588,22 +714,11 @@ LIMIT ?""")
 
         self.assertEqual(Unit.many(like="p").count(), 1)
 
-    def test_values_retrieve(self):
-
-        model = unittest.mock.MagicMock()
-        people = unittest.mock.MagicMock()
-        stuff = unittest.mock.MagicMock()
-        things = unittest.mock.MagicMock()
+        self.assertEqual(self.source.count(Unit.many(), relations_sql.SQL("SELECT 1 AS `total` WHERE 0")), 0)
 
-        people.kind = str
-        stuff.kind = list
-        things.kind = dict
-
-        people.store = "people"
-        stuff.store = "stuff"
-        things.store = "things"
+    def test_values_retrieve(self):
 
-        model._fields._order = [people, stuff, things]
+        model = types.SimpleNamespace(_jsonify=["stuff", "things"])
 
         values = {
             "people": "sure",
@@ -794,6 +909,37 @@ LIMIT ?""")
         model = Net.many(subnet__max_value=int(ipaddress.IPv4Address('1.2.3.0')))
         self.assertEqual(len(model), 0)
 
+        Meta("big", things={"big": 10**20}).create()
+        things = Meta.one(name="big").things
+        self.assertEqual(things, {"big": 10**20})
+        self.assertIsInstance(things["big"], int)
+
+    def test_retrieve_iter(self):
+
+        self.source.execute(Unit.define())
+        self.source.execute(Test.define())
+
+        Unit([["stuff"], ["people"], ["things"]]).create()
+
+        models = self.source.retrieve_iter(Unit.many(name__in=["people", "things"]))
+
+        unit = next(models)
+        self.assertEqual(unit.id, 2)
+        self.assertEqual(unit.name, "people")
+        self.assertEqual(unit._action, "update")
+
+        self.assertEqual([unit.name for unit in models], ["things"])
+
+        cursor = unittest.mock.MagicMock()
+        cursor.__iter__.return_value = iter([(1, "stuff"), (2, "people")])
+
+        with unittest.mock.patch.object(self.source, "retrieve_cursor", return_value=(cursor, ["id", "name"])):
+            models = self.source.retrieve_iter(Unit.many())
+            next(models)
+            models.close()
+
+        cursor.close.assert_called_once_with()
+
     def test_titles(self):
 
         self.source.execute(Unit.define())
@@ -918,6 +1064,20 @@ LIMIT ?""")
         self.assertEqual(unit.test[0].id, 1)
         self.assertEqual(unit.test[0].name, "moar")
 
+        units = Unit([["ping"], ["pong"], ["pang"]]).create()
+        units[0].name = "pinged"
+        units[1].name = "ponged"
+
+        self.assertEqual(units.update(), 2)
+        self.assertEqual(Unit.many(id__in=units.id).sort("id").name, ["pinged", "ponged", "pang"])
+
+        unit = Unit.one(name="pang")
+        unit.name = "pinged"
+        unit.test.add("orphan")
+
+        self.assertRaises(sqlite3.IntegrityError, unit.update)
+        self.assertEqual(Test.many(name="orphan").count(), 0)
+
         Meta("yep", True, 1.1, {"tom"}, [1, None], {"a": 1}).create()
         Meta.one(name="yep").set(flag=False, people=set(), stuff=[], things={}).update()
 
@@ -964,6 +1124,12 @@ LIMIT ?""")
         self.assertEqual(query.sql, """DELETE FROM `test_source`.`unit` WHERE `id` IN (?,?)""")
         self.assertEqual(query.args, model.id)
 
+        query = self.source.delete_query(model, [model[0].id])
+        query.generate()
+
+        self.assertEqual(query.sql, """DELETE FROM `test_source`.`unit` WHERE `id` IN (?)""")
+        self.assertEqual(query.args, [model[0].id])
+
         model = Plain(name="yep").create()
 
         self.assertRaisesRegex(relations.ModelError, "nothing to delete from", model.query, "delete")
@@ -989,6 +1155,10 @@ LIMIT ?""")
 
         self.assertEqual(Test.many().delete(), 0)
 
+        units = Unit([["ping"], ["pong"], ["pang"]], _chunk=2).create()
+        self.assertEqual(units.delete(), 3)
+        self.assertEqual(len(Unit.many()), 0)
+
         plain = Plain(0, "nope").create()
         self.assertRaisesRegex(relations.ModelError, "plain: nothing to delete from", plain.delete)
 
@@ -1090,14 +1260,14 @@ DROP TABLE `test_source`.`_old_simple`;
 
         self.source.load(f"ddl/{self.source.name}/{self.source.KIND}/definition.sql")
 
-        cursor = self.source.connection.cursor()
+        self.cursor.execute("SELECT COUNT(*) as `total` FROM `test_source`.`unit`")
 
-        cursor.execute("SELECT COUNT(*) as `total` FROM `test_source`.`unit`")
-
-        self.assertEqual(cursor.fetchone()["total"], 0)
+        self.assertEqual(self.cursor.fetchone()["total"], 0)
 
     def test_list(self):
 
+        self.assertEqual(self.source.list(f"ddl/{self.source.name}/{self.source.KIND}"), {})
+
         os.makedirs(f"ddl/{self.source.name}/{self.source.KIND}")
 
         pathlib.Path(f"ddl/{self.source.name}/{self.source.KIND}/definition.json").touch()
@@ -1140,3 +1310,14 @@ DROP TABLE `test_source`.`_old_simple`;
         self.assertEqual(Case.many().count(), 0)
 
         self.assertFalse(self.source.migrate(f"ddl/{self.source.name}/{self.source.KIND}"))
+
+        with open(f"ddl/{self.source.name}/{self.source.KIND}/migration-9998.sql", "w") as migration_file:
+            migration_file.write("ALTER TABLE `test_source`.`nope` ADD `name` TEXT;\n")
+
+        with open(f"ddl/{self.source.name}/{self.source.KIND}/migration-9999.sql", "w") as migration_file:
+            migration_file.write("CREATE TABLE `test_source`.`later` (`id` INTEGER);\n")
+
+        self.assertRaises(sqlite3.OperationalError, self.source.migrate, f"ddl/{self.source.name}/{self.source.KIND}")
+
+        self.cursor.execute("SELECT `stamp` FROM `test_source`.`_relations_migration`")
+        self.assertNotIn("9999", [row["stamp"] for row in self.cursor.fetchall()])